@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 import os
+import re
+import sys
+import stat
 import json
+import math
+import time
+import shlex
+import select
+import signal
 import socket
 import struct
 import logging
+import threading
+import subprocess
 import requests
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from email.utils import formatdate
+from functools import lru_cache, partial
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from requests.auth import HTTPBasicAuth
+from urllib.parse import unquote
+
+from event_protocol import decode_event, parse_address
+from rpc_trace import get_recorder, set_recorder, TraceRecorder
 
 logging.basicConfig(
     level = logging.INFO,
@@ -25,23 +45,65 @@ def get_env_strict( key ):
     return value
 
 
-# Strict Configuration - No defaults, no startup without these
-try:
-    TV_IP = get_env_strict( 'TV_IP' )
-    TV_PSK = get_env_strict( 'TV_PSK' )
-    TV_MAC = get_env_strict( 'TV_MAC' )
-    TV_HDMI_PORT = get_env_strict( 'TV_HDMI_PORT' )
-    KODI_HOST = get_env_strict( 'KODI_HOST' )
-    KODI_PORT = get_env_strict( 'KODI_PORT' )
-    KODI_USER = get_env_strict( 'KODI_USER' )
-    KODI_PASS = get_env_strict( 'KODI_PASS' )
-    SERVER_PORT = int( get_env_strict( 'SERVER_PORT' ) )
-except ( RuntimeError, ValueError ) as e:
-    import sys
-    print( f"Server failed to start: {e}", file = sys.stderr )
-    sys.exit( 1 )
-
 REQUEST_TIMEOUT = 3
+# Keep-alive connections with no request for this long are closed
+IDLE_TIMEOUT = 30
+# Compact separators; responses are read by machines, not people
+JSON_ENCODER = json.JSONEncoder( separators = ( ',', ':' ) )
+# Shared deadline for a group request (/all/...) across every device
+FAN_OUT_DEADLINE = 10
+# Statuses that mean a TV (or Kodi) failed, rather than the request
+UPSTREAM_ERRORS = ( 502, 504 )
+# /events: one upstream poll per interval, whatever the number of clients
+EVENT_POLL_INTERVAL = 2
+# /events: a comment line is sent after this many idle seconds
+EVENT_HEARTBEAT = 15
+# /events: an idle stream checks this often whether its client hung up
+EVENT_LIVENESS = 1
+# /events: per-client backlog; a client that falls behind gets a snapshot
+EVENT_BUFFER = 64
+# An incomplete capability discovery is retried after this many seconds
+CAPABILITY_RETRY = 60
+# /frontend/switch: seconds to wait after SIGTERM before SIGKILL
+FRONTEND_STOP_TIMEOUT = 5
+# frontend -> ( default command, process name whose group is adopted at
+# startup ); launches are tracked by process group too, as launchers such
+# as `kodi` run the real binary as a child
+FRONTENDS = {
+    "kodi": ( "kodi",
+              "kodi.bin" ),
+    "pegasus":
+        (
+            "pegasus-fe --disable-menu-shutdown --disable-menu-suspend",
+            "pegasus-fe"
+        )
+}
+# Admission lanes, most urgent first
+LANE_POWER, LANE_INPUT, LANE_VOLUME = range( 3 )
+# Requests running at once; the last ADMISSION_RESERVED are power-only
+ADMISSION_WORKERS = 6
+ADMISSION_RESERVED = 2
+# Requests waiting for a slot, across all lanes
+ADMISSION_BACKLOG = 16
+# Longest wait for a slot per lane; a late volume press is worse than none
+ADMISSION_WAIT = ( 10, 5, 1 )
+# Per-client token bucket (requests per second, burst); power is exempt
+CLIENT_RATE = 10
+CLIENT_BURST = 20
+# Steps per macro or batch; each is charged a token, so at most the burst
+MAX_STEPS = 16
+ALL_DEVICES = "all"
+DEFAULT_DEVICE = "default"
+DEVICE_KEYS = (
+    'tv_ip',
+    'tv_psk',
+    'tv_mac',
+    'tv_hdmi_port',
+    'kodi_host',
+    'kodi_port',
+    'kodi_user',
+    'kodi_pass'
+)
 
 
 class BraviaTVError( Exception ):
@@ -49,6 +111,14 @@ class BraviaTVError( Exception ):
     pass
 
 
+class AdmissionRejected( Exception ):
+    """Raised when a request is shed; carries its status and Retry-After."""
+    def __init__( self, code, message, retry_after ):
+        super().__init__( message )
+        self.code = code
+        self.retry_after = retry_after
+
+
 def wake_on_lan( mac ):
     add_oct = mac.replace( ':', '' ).replace( '-', '' )
     data = b'FFFFFFFFFFFF' + ( add_oct * 16 ).encode()
@@ -60,28 +130,376 @@ def wake_on_lan( mac ):
         sock.sendto( send_data, ( '255.255.255.255', 9 ) )
 
 
-class MediaController:
+class Device:
+    """One TV and the Kodi instance attached to it."""
+    def __init__( self, name, **config ):
+        self.name = name
+        for key in DEVICE_KEYS:
+            value = config.get( key )
+            if value is None or not str( value ).strip():
+                raise RuntimeError(
+                    f"Device '{name}' is missing mandatory key '{key}'."
+                )
+            setattr( self, key, str( value ) )
+        # held while capabilities are discovered, so only one discovery
+        # per TV runs at a time
+        self.lock = threading.Lock()
+        # one command at a time per TV, so a power-off and power-on (or two
+        # toggles) cannot overtake each other
+        self.command_lock = CommandLock()
+        self.capabilities = None
+
+
+class TVCapabilities:
+    """
+    What a TV supports: API versions, external inputs and volume ranges.
+    Discovered once per device (at startup and again after the TV was
+    unreachable) so routes can pick a supported call without asking.
+    Empty collections mean "unknown", not "unsupported".
+    """
     def __init__( self ):
-        self.tv_url = f"http://{TV_IP}/sony/"
-        self.kodi_url = f"http://{KODI_HOST}:{KODI_PORT}/jsonrpc"
-        self.kodi_auth = HTTPBasicAuth( KODI_USER, KODI_PASS )
+        self.versions = {}
+        self.inputs = set()
+        self.volume = {}
+        self.complete = False
+        self.discovered_at = time.monotonic()
+
+    def supports( self, service, method ):
+        return ( service, method ) in self.versions
+
+    def version( self, service, method ):
+        return self.versions.get( ( service, method ), "1.0" )
+
+    def inherit( self, other ):
+        """Keeps what an earlier discovery found where this one failed."""
+        self.versions = self.versions or other.versions
+        self.inputs = self.inputs or other.inputs
+        self.volume = self.volume or other.volume
+
+
+def discover_capabilities( ctrl ):
+    caps = TVCapabilities()
+    try:
+        services = first_result(
+            ctrl.tv_req(
+                'guide',
+                'getSupportedApiInfo',
+                {
+                    "services": [ "system",
+                                  "avContent",
+                                  "audio" ]
+                }
+            )
+        )
+        for service in services:
+            for api in service.get( 'apis', [] ):
+                versions = [
+                    version.get( 'version' )
+                    for version in api.get( 'versions', [] )
+                ]
+                # 1.0 keeps the request format the routes are written for
+                caps.versions[ ( service.get( 'service' ),
+                                 api.get( 'name' ) ) ] = (
+                                     "1.0" if "1.0" in versions else
+                                     min( versions,
+                                          default = "1.0" )
+                                 )
+    except (
+        BraviaTVError,
+        requests.RequestException,
+        AttributeError,
+        TypeError
+    ) as e:
+        logger.info( f"{ctrl.device.name}: API discovery failed: {e}" )
+    try:
+        inputs = first_result(
+            ctrl.tv_req( 'avContent',
+                         'getCurrentExternalInputsStatus' )
+        )
+        caps.inputs = {
+            item.get( 'uri' )
+            for item in inputs
+            if item.get( 'uri' )
+        }
+    except (
+        BraviaTVError,
+        requests.RequestException,
+        AttributeError,
+        TypeError
+    ) as e:
+        logger.info( f"{ctrl.device.name}: input discovery failed: {e}" )
+    try:
+        targets = first_result( ctrl.tv_req( 'audio', 'getVolumeInformation' ) )
+        caps.volume = {
+            target.get( 'target' ):
+                (
+                    target.get( 'minVolume',
+                                0 ),
+                    target.get( 'maxVolume',
+                                100 )
+                )
+            for target in targets
+        }
+    except (
+        BraviaTVError,
+        requests.RequestException,
+        AttributeError,
+        TypeError
+    ) as e:
+        logger.info( f"{ctrl.device.name}: volume discovery failed: {e}" )
+    caps.complete = bool( caps.versions and caps.inputs and caps.volume )
+    logger.info(
+        f"{ctrl.device.name}: {len( caps.versions )} APIs, "
+        f"inputs {sorted( caps.inputs )}, volume {caps.volume}"
+        f"{'' if caps.complete else ' (incomplete)'}"
+    )
+    return caps
+
+
+@lru_cache( maxsize = 256 )
+def split_path( path ):
+    """Lower-cased path segments; cached, as clients repeat their paths."""
+    path = unquote( path.split( "?", 1 )[ 0 ] ).casefold()
+    return tuple( segment for segment in path.split( "/" ) if segment )
+
+
+def macro_name( name ):
+    return name.casefold().replace( " ", "" ).replace( ".", "" )
+
+
+class DeviceRegistry:
+    """
+    Devices keyed by room name. Paths may be scoped to a room
+    (/<room>/tvpower/on), to every room (/all/tvpower/off) or left
+    unscoped, in which case the default room is used. Macros are named
+    lists of such paths.
+    """
+    def __init__( self, devices, default = None, macros = None ):
+        self.devices = {
+            device.name: device
+            for device in devices
+        }
+        if not self.devices:
+            raise RuntimeError( "At least one device must be configured." )
+        if ALL_DEVICES in self.devices:
+            raise RuntimeError( f"'{ALL_DEVICES}' is a reserved room name." )
+        self.default = default or next( iter( self.devices ) )
+        if self.default not in self.devices:
+            raise RuntimeError( f"Unknown default room '{self.default}'." )
+        self.macros = {}
+        for name, steps in ( macros or {} ).items():
+            if not isinstance( steps, list ):
+                raise RuntimeError(
+                    f"Macro '{name}' must be a list of route paths."
+                )
+            error = self.check_steps( steps )
+            if error:
+                raise RuntimeError( f"Macro '{name}': {error}" )
+            self.macros[ macro_name( name ) ] = steps
+        # background work: the /events poller and capability discovery
+        self.executor = ThreadPoolExecutor(
+            max_workers = max( 4,
+                               2 * len( self.devices ) ),
+            thread_name_prefix = "background"
+        )
+        # a thread per device for every request admission lets run at
+        # once, so a group request never queues behind another one
+        self.fan_out_executor = ThreadPoolExecutor(
+            max_workers = ADMISSION_WORKERS * len( self.devices ),
+            thread_name_prefix = "fan-out"
+        )
+
+    def resolve( self, path ):
+        """
+        Returns ( devices, slug, scope ) for a request path, where scope is
+        ALL_DEVICES, the room name, or None for an unscoped path.
+        """
+        segments = split_path( path )
+        if segments and segments[ 0 ] == ALL_DEVICES:
+            devices = list( self.devices.values() )
+            scope = ALL_DEVICES
+            segments = segments[ 1 : ]
+        elif segments and segments[ 0 ] in self.devices:
+            devices = [ self.devices[ segments[ 0 ] ] ]
+            scope = segments[ 0 ]
+            segments = segments[ 1 : ]
+        else:
+            devices = [ self.devices[ self.default ] ]
+            scope = None
+        slug = "".join( segments ).replace( ".", "" ).replace( " ", "" )
+        return devices, slug, scope
+
+    def check_steps( self, steps ):
+        """
+        An error for the first macro/batch step that is not a device route
+        (frontend switches, macros and batches do not nest), else None.
+        """
+        if len( steps ) > MAX_STEPS:
+            return f"At most {MAX_STEPS} steps are allowed"
+        for step in steps:
+            if not isinstance( step, str ):
+                return f"Each step must be a route path, got {step!r}"
+            if find_route( self.resolve( step )[ 1 ] )[ 0 ] is None:
+                return f"Not a device route: {step}"
+        return None
+
+    def fan_out( self, devices, slug, deadline = FAN_OUT_DEADLINE ):
+        """
+        Runs the route against every device concurrently. Devices that
+        have not answered by the shared deadline are reported as 504; one
+        that has not started its command by then never does.
+        """
+        expires = time.monotonic() + deadline
+        futures = {
+            self.fan_out_executor.submit(
+                handle_request,
+                device,
+                slug,
+                expires
+            ): device.name
+            for device in devices
+        }
+        done, _ = wait( futures, timeout = deadline )
+        results = {}
+        for future, name in futures.items():
+            if future in done:
+                code, body = future.result()
+            else:
+                future.cancel()
+                logger.warning( f"{name}: no answer within {deadline}s" )
+                code, body = 504, {
+                    "error": "Deadline exceeded"
+                }
+            results[ name ] = {
+                "status": code,
+                "body": body
+            }
+        return combined_status(
+            [ result[ "status" ] for result in results.values() ]
+        ), {
+            "devices": results
+        }
+
+
+def load_registry():
+    """
+    Builds the registry from the JSON file named by BRAVIA_DEVICES, e.g.
+    {"default": "living", "devices": {"living": {"tv_ip": ..., ...}},
+     "macros": {"movie night": ["tvpower/on", "tvinput/hdmi2"]}}.
+    Without it, a single device is read from the legacy environment
+    variables (TV_IP, TV_PSK, ...).
+    """
+    config_path = os.environ.get( 'BRAVIA_DEVICES' )
+    if not config_path:
+        return DeviceRegistry(
+            [
+                Device(
+                    DEFAULT_DEVICE,
+                    **{
+                        key: get_env_strict( key.upper() )
+                        for key in DEVICE_KEYS
+                    }
+                )
+            ]
+        )
+    try:
+        with open( config_path ) as f:
+            config = json.load( f )
+    except ( OSError, ValueError ) as e:
+        raise RuntimeError( f"Could not read device config: {e}" )
+    devices = [
+        Device( name.casefold(),
+                **device_config )
+        for name, device_config in config.get( 'devices', {} ).items()
+    ]
+    default = config.get( 'default' )
+    return DeviceRegistry(
+        devices,
+        default and default.casefold(),
+        config.get( 'macros' )
+    )
+
+
+class MediaController:
+    def __init__( self, device ):
+        self.device = device
+        self.tv_url = f"http://{device.tv_ip}/sony/"
+        self.kodi_url = f"http://{device.kodi_host}:{device.kodi_port}/jsonrpc"
+        self.kodi_auth = HTTPBasicAuth( device.kodi_user, device.kodi_pass )
+
+    def capabilities( self ):
+        """
+        The device's cached capabilities, without waiting on the TV. When
+        they are missing, or incomplete and due for a retry, discovery is
+        started in the background and this request makes do with what is
+        known; empty capabilities mean "unknown", as after a partial answer.
+        """
+        device = self.device
+        caps = device.capabilities
+        if (
+            caps is None or not caps.complete and
+            time.monotonic() - caps.discovered_at >= CAPABILITY_RETRY
+        ) and not device.lock.locked():
+            threading.Thread(
+                target = self.discover,
+                name = f"discovery-{device.name}",
+                daemon = True
+            ).start()
+        return caps if caps is not None else TVCapabilities()
+
+    def discover( self ):
+        """Rediscovers the capabilities, unless that is already underway."""
+        device = self.device
+        if not device.lock.acquire( blocking = False ):
+            return
+        try:
+            fresh = discover_capabilities( self )
+            if device.capabilities is not None:
+                fresh.inherit( device.capabilities )
+            device.capabilities = fresh
+        finally:
+            device.lock.release()
+
+    def _traced( self, kind, request, call ):
+        """Runs call(), recording the exchange when tracing is enabled."""
+        recorder = get_recorder()
+        if recorder is None:
+            return call()
+        started = time.time()
+        try:
+            response = call()
+        except Exception as e:
+            recorder.record(
+                kind,
+                request,
+                error = f"{type( e ).__name__}: {e}",
+                started = started,
+                duration = time.time() - started,
+                device = self.device.name
+            )
+            raise
+        recorder.record(
+            kind,
+            request,
+            response = response,
+            started = started,
+            duration = time.time() - started,
+            device = self.device.name
+        )
+        return response
 
     def kodi_stop( self ):
         """Authenticates and stops any active Kodi player."""
-        logger.info( "Sending authenticated stop command to Kodi..." )
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "Player.GetActivePlayers",
-            "id": 1
-        }
+        return self._traced( 'kodi_stop',
+                             {},
+                             self._kodi_stop )
+
+    def _kodi_stop( self ):
+        logger.info(
+            f"{self.device.name}: Sending authenticated stop command to Kodi..."
+        )
         try:
-            r = requests.post(
-                self.kodi_url,
-                json = payload,
-                auth = self.kodi_auth,
-                timeout = 2
-            ).json()
-            for player in r.get( 'result', [] ):
+            for player in self.kodi_active_players():
                 p_id = player[ 'playerid' ]
                 requests.post(
                     self.kodi_url,
@@ -96,26 +514,60 @@ class MediaController:
                     auth = self.kodi_auth,
                     timeout = 2
                 )
-                logger.info( f"Kodi: Stopped Player ID {p_id}" )
+                logger.info(
+                    f"{self.device.name}: Kodi stopped Player ID {p_id}"
+                )
         except Exception as e:
-            logger.warning( f"Kodi connection failed: {e}" )
+            logger.warning( f"{self.device.name}: Kodi connection failed: {e}" )
+
+    def kodi_active_players( self ):
+        payload = {
+            "jsonrpc": "2.0",
+            "method": "Player.GetActivePlayers",
+            "id": 1
+        }
+        r = requests.post(
+            self.kodi_url,
+            json = payload,
+            auth = self.kodi_auth,
+            timeout = 2
+        ).json()
+        return r.get( 'result', [] )
 
     def tv_req( self, service, method, params = None ):
+        return self._traced(
+            'tv_req',
+            {
+                "service": service,
+                "method": method,
+                "params": params
+            }, lambda: self._tv_req( service, method, params )
+        )
+
+    def _tv_req( self, service, method, params = None ):
         headers = {
-            'X-Auth-PSK': TV_PSK
+            'X-Auth-PSK': self.device.tv_psk
         }
+        caps = self.device.capabilities
         body = {
             "method": method,
-            "version": "1.0",
+            "version": caps.version( service,
+                                     method ) if caps else "1.0",
             "id": 1,
             "params": [ params ] if params else []
         }
-        r = requests.post(
-            self.tv_url + service,
-            json = body,
-            headers = headers,
-            timeout = REQUEST_TIMEOUT
-        )
+        try:
+            r = requests.post(
+                self.tv_url + service,
+                json = body,
+                headers = headers,
+                timeout = REQUEST_TIMEOUT
+            )
+        except ( requests.ConnectionError, requests.Timeout ):
+            # rediscover once it is reachable again, it may have changed
+            if caps is not None:
+                caps.complete = False
+            raise
         if not r.ok:
             raise BraviaTVError(
                 f"TV returned {r.status_code}: {r.text[:200]}"
@@ -126,13 +578,21 @@ class MediaController:
             raise BraviaTVError( "TV returned invalid JSON" )
 
     def tv_ircc( self, code_key ):
+        return self._traced(
+            'tv_ircc',
+            {
+                "code_key": code_key
+            }, lambda: self._tv_ircc( code_key )
+        )
+
+    def _tv_ircc( self, code_key ):
         codes = {
             "vol_up": "AAAAAQAAAAEAAAASAw==",
             "vol_down": "AAAAAQAAAAEAAAATAw==",
             "vol_mute": "AAAAAQAAAAEAAAAUAw=="
         }
         headers = {
-            'X-Auth-PSK': TV_PSK,
+            'X-Auth-PSK': self.device.tv_psk,
             'SOAPAction': '"urn:schemas-sony-com:service:IRCC:1#X_SendIRCC"'
         }
         payload = f'<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:X_SendIRCC xmlns:u="urn:schemas-sony-com:service:IRCC:1"><IRCCCode>{codes[code_key]}</IRCCCode></u:X_SendIRCC></s:Body></s:Envelope>'
@@ -148,146 +608,1256 @@ class MediaController:
             return {}
 
 
+def first_result( resp ):
+    """The first element of a Bravia 'result' list, or {}."""
+    result = ( resp or {} ).get( 'result' ) or [ {} ]
+    return result[ 0 ]
+
+
+def poll_state( device ):
+    """Power, input, volume and Kodi player state of one device."""
+    ctrl = MediaController( device )
+    state = {
+        "power": None,
+        "input": None,
+        "volume": None,
+        "mute": None,
+        "kodi": None
+    }
+    try:
+        state[ "power" ] = first_result(
+            ctrl.tv_req( 'system',
+                         'getPowerStatus' )
+        ).get( 'status' )
+        if state[ "power" ] == "active":
+            state[ "input" ] = first_result(
+                ctrl.tv_req( 'avContent',
+                             'getPlayingContentInfo' )
+            ).get( 'uri' )
+            targets = first_result(
+                ctrl.tv_req( 'audio',
+                             'getVolumeInformation' )
+            )
+            if not isinstance( targets, list ):
+                targets = []
+            speaker = next(
+                (
+                    target for target in targets
+                    if target.get( 'target' ) == 'speaker'
+                ),
+                targets[ 0 ] if targets else {}
+            )
+            state[ "volume" ] = speaker.get( 'volume' )
+            state[ "mute" ] = speaker.get( 'mute' )
+    except ( BraviaTVError, requests.RequestException, AttributeError ) as e:
+        logger.debug( f"{device.name}: TV poll failed: {e}" )
+    try:
+        state[ "kodi" ] = [
+            {
+                "playerid": player.get( 'playerid' ),
+                "type": player.get( 'type' )
+            } for player in ctrl.kodi_active_players()
+        ]
+    except ( requests.RequestException, ValueError, AttributeError ) as e:
+        logger.debug( f"{device.name}: Kodi poll failed: {e}" )
+    return state
+
+
+def encode_event( event, data ):
+    return f"event: {event}\ndata: {JSON_ENCODER.encode( data )}\n\n".encode()
+
+
+class EventSubscriber:
+    """A bounded queue of encoded events for one /events client."""
+    def __init__( self, rooms ):
+        self.rooms = rooms
+        self.events = deque( maxlen = EVENT_BUFFER )
+        self.overflowed = False
+        self.cond = threading.Condition()
+
+    def push( self, room, event ):
+        if self.rooms is not None and room not in self.rooms:
+            return
+        with self.cond:
+            if len( self.events ) == self.events.maxlen:
+                self.overflowed = True
+            self.events.append( event )
+            self.cond.notify()
+
+    def drain( self, timeout ):
+        """
+        Returns the pending events ([] on timeout), or None when events
+        were dropped and the client has to be resynchronised.
+        """
+        with self.cond:
+            if not self.events:
+                self.cond.wait( timeout )
+            if self.overflowed:
+                self.overflowed = False
+                self.events.clear()
+                return None
+            events = list( self.events )
+            self.events.clear()
+            return events
+
+
+class StateHub:
+    """
+    Polls every device on one shared thread and pushes the differences to
+    the /events subscribers. The poller only runs while someone listens,
+    so any number of dashboards costs a single upstream poll.
+    """
+    def __init__( self, registry ):
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.state = {}
+        self.poller = None
+        self.wakeup = threading.Event()
+
+    def subscribe( self, rooms ):
+        subscriber = EventSubscriber( rooms )
+        with self.lock:
+            self.subscribers.add( subscriber )
+            if self.poller is None:
+                self.poller = threading.Thread(
+                    target = self._run,
+                    name = "state-poller",
+                    daemon = True
+                )
+                self.poller.start()
+        return subscriber
+
+    def unsubscribe( self, subscriber ):
+        with self.lock:
+            self.subscribers.discard( subscriber )
+            if not self.subscribers:
+                # let the poller see it is no longer needed
+                self.wakeup.set()
+
+    def nudge( self ):
+        """Polls right away, e.g. after a route changed the TV state."""
+        if self.subscribers:
+            self.wakeup.set()
+
+    def snapshot( self, rooms ):
+        with self.lock:
+            return {
+                room: dict( state )
+                for room, state in self.state.items()
+                if rooms is None or room in rooms
+            }
+
+    def _poll( self ):
+        devices = list( self.registry.devices.values() )
+        futures = {
+            self.registry.executor.submit( poll_state,
+                                           device ): device.name
+            for device in devices
+        }
+        done, _ = wait( futures, timeout = FAN_OUT_DEADLINE )
+        for future in done:
+            room = futures[ future ]
+            state = future.result()
+            with self.lock:
+                previous = self.state.get( room,
+                                           {} )
+                self.state[ room ] = state
+                subscribers = list( self.subscribers )
+            changes = {
+                key: value
+                for key, value in state.items()
+                if previous.get( key ) != value
+            }
+            if not changes or not subscribers:
+                continue
+            event = encode_event(
+                "change",
+                {
+                    "room": room,
+                    "changes": changes
+                }
+            )
+            for subscriber in subscribers:
+                subscriber.push( room, event )
+
+    def _run( self ):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    # nobody is listening; the cached state goes stale
+                    self.poller = None
+                    self.state = {}
+                    return
+            self._poll()
+            self.wakeup.wait( EVENT_POLL_INTERVAL )
+            self.wakeup.clear()
+
+
+def group_running( pgid ):
+    """
+    Whether a process group has a member that is not a zombie. Orphans of
+    a killed launcher are re-parented to init, which is not always quick
+    (or, in some containers, willing) to reap them. Assumes the group
+    is running where /proc is not available.
+    """
+    try:
+        entries = os.listdir( '/proc' )
+    except OSError:
+        return True
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open( f'/proc/{entry}/stat' ) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # after the "(command)" field: state, ppid, pgrp, ...
+        state, _, pgrp = stat.rsplit( ')', 1 )[ 1 ].split()[ : 3 ]
+        if int( pgrp ) == pgid and state not in ( 'Z', 'X' ):
+            return True
+    return False
+
+
+class FrontendProcess:
+    """
+    A frontend's process group, either started by the supervisor (in a
+    new session, reaped by a waiter thread) or adopted at startup from the
+    group of an already running frontend process. Signals go to the whole
+    group: a launcher such as the stock `kodi` script runs `kodi.bin` as a
+    child instead of exec'ing it.
+    """
+    def __init__( self, name, pid, popen = None ):
+        self.name = name
+        self.pid = pid
+        self.popen = popen
+        if popen is not None:
+            self.pgid = pid
+        else:
+            try:
+                self.pgid = os.getpgid( pid )
+            except ProcessLookupError:
+                self.pgid = None
+            if self.pgid == os.getpgrp():
+                # never signal our own group; fall back to the process
+                self.pgid = None
+        if popen is not None:
+            threading.Thread(
+                target = self._reap,
+                name = f"reap-{name}",
+                daemon = True
+            ).start()
+
+    def _reap( self ):
+        # the launcher must not linger as a zombie, or the group looks alive
+        code = self.popen.wait()
+        logger.info( f"Frontend {self.name} ({self.pid}) exited with {code}" )
+
+    def _signal( self, signum ):
+        if self.pgid is not None:
+            os.killpg( self.pgid, signum )
+        else:
+            os.kill( self.pid, signum )
+
+    def alive( self ):
+        try:
+            self._signal( 0 )
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        if self.pgid is None:
+            return True
+        return group_running( self.pgid )
+
+    def wait( self, timeout ):
+        deadline = time.monotonic() + timeout
+        while self.alive():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep( 0.05 )
+        return True
+
+    def stop( self, timeout ):
+        """
+        SIGTERM, then SIGKILL after timeout. Returns ( stopped, killed ).
+        """
+        try:
+            self._signal( signal.SIGTERM )
+        except ProcessLookupError:
+            return True, False
+        if self.wait( timeout ):
+            return True, False
+        logger.warning( f"Frontend {self.name} ignored SIGTERM, killing it" )
+        try:
+            self._signal( signal.SIGKILL )
+        except ProcessLookupError:
+            return True, False
+        return self.wait( timeout ), True
+
+
+class FrontendSupervisor:
+    """
+    Switches between the Kodi and Pegasus frontends. The process table is
+    scanned once at startup; after that the supervisor knows which
+    frontend runs from the children it started and reaps.
+    """
+    def __init__( self, commands ):
+        self.commands = commands
+        self.lock = threading.Lock()
+        self.processes = {}
+        for name, ( _, process_name ) in FRONTENDS.items():
+            try:
+                pids = subprocess.run(
+                    [ 'pgrep',
+                      '-x',
+                      process_name ],
+                    capture_output = True,
+                    text = True,
+                    timeout = 2
+                ).stdout.split()
+            except ( OSError, subprocess.SubprocessError ):
+                pids = []
+            for pid in pids:
+                process = FrontendProcess( name, int( pid ) )
+                if process.alive():
+                    logger.info(
+                        f"Adopted running frontend {name} "
+                        f"({pid}, group {process.pgid})"
+                    )
+                    self.processes[ name ] = process
+                    break
+
+    def running( self ):
+        return [
+            name for name, process in self.processes.items() if process.alive()
+        ]
+
+    def switch( self, target = None ):
+        """
+        Makes target the only running frontend; without a target, toggles
+        from Kodi to Pegasus and back. Returns ( code, body ).
+        """
+        if target is not None and target not in self.commands:
+            return 404, {
+                "error": f"Unknown frontend: {target}"
+            }
+        started = time.monotonic()
+        with self.lock:
+            running = self.running()
+            if target is None:
+                target = "pegasus" if "kodi" in running else "kodi"
+            stopped, killed = [], []
+            for name in running:
+                if name == target:
+                    continue
+                done, was_killed = self.processes[ name ].stop(
+                    FRONTEND_STOP_TIMEOUT
+                )
+                if was_killed:
+                    killed.append( name )
+                if not done:
+                    logger.error( f"Frontend {name} survived SIGKILL" )
+                    return 500, {
+                        "error": f"Could not stop {name}",
+                        "stopped": stopped,
+                        "killed": killed
+                    }
+                del self.processes[ name ]
+                stopped.append( name )
+            launched = target not in running
+            if launched:
+                popen = subprocess.Popen(
+                    self.commands[ target ],
+                    stdin = subprocess.DEVNULL,
+                    stdout = subprocess.DEVNULL,
+                    stderr = subprocess.DEVNULL,
+                    start_new_session = True
+                )
+                self.processes[ target ] = FrontendProcess(
+                    target,
+                    popen.pid,
+                    popen
+                )
+        elapsed_ms = ( time.monotonic() - started ) * 1000
+        logger.info( f"Frontend switched to {target} in {elapsed_ms:.1f}ms" )
+        return 200, {
+            "frontend": target,
+            "stopped": stopped,
+            "killed": killed,
+            "launched": launched,
+            "elapsed_ms": round( elapsed_ms,
+                                 1 )
+        }
+
+
+def route_lane( slug ):
+    """
+    The admission lane of a route; a bare /tvpower is only a status read.
+    None for macros and batches, whose steps are admitted one by one.
+    """
+    if slug.startswith( "macro" ) or slug == "batch":
+        return None
+    if slug.startswith( "onscreensaver" ) or (
+        slug.startswith( "tvpower" ) and slug != "tvpower"
+    ):
+        return LANE_POWER
+    if slug.startswith( "tvvolume" ):
+        return LANE_VOLUME
+    return LANE_INPUT
+
+
+def changes_state( slug ):
+    """
+    Whether a route can change what /events reports, so that succeeding
+    is worth an early poll: a TV command, macro or batch, but not a
+    status read, a frontend switch or an unknown route.
+    """
+    if slug.startswith( "macro" ) or slug == "batch":
+        return True
+    return slug != "tvpower" and find_route( slug )[ 0 ] is not None
+
+
+class AdmissionTicket:
+    __slots__ = ( 'state',
+                 )
+
+    def __init__( self ):
+        # "waiting", "admitted" or "shed"
+        self.state = "waiting"
+
+
+class CommandLock:
+    """
+    Lets one command at a time run against a TV. Waiters are served most
+    urgent lane first, then in arrival order, so a power request waits
+    for the command already running, not for every volume press that
+    was admitted before it.
+    """
+    def __init__( self ):
+        self.lock = threading.Condition()
+        self.busy = False
+        self.queues = [ deque() for _ in range( LANE_VOLUME + 1 ) ]
+
+    def acquire( self, lane = LANE_INPUT, timeout = None ):
+        """False if the TV was not free within timeout seconds."""
+        with self.lock:
+            if not self.busy:
+                self.busy = True
+                return True
+            ticket = AdmissionTicket()
+            self.queues[ lane ].append( ticket )
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while ticket.state == "waiting":
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.queues[ lane ].remove( ticket )
+                        return False
+                self.lock.wait( remaining )
+            return True
+
+    def release( self ):
+        """Hands the TV straight to the most urgent waiter, if any."""
+        with self.lock:
+            for queue in self.queues:
+                if queue:
+                    queue.popleft().state = "admitted"
+                    self.lock.notify_all()
+                    return
+            self.busy = False
+
+
+class AdmissionController:
+    """
+    Bounds the work bravia_server takes on. At most ADMISSION_WORKERS
+    requests run at once, and ADMISSION_RESERVED of those slots are kept
+    for power and screensaver requests, so they never queue behind a burst
+    of volume presses. Other requests wait in per-lane FIFOs, served most
+    urgent lane first. When the backlog is full, the newest request of a
+    less urgent lane is shed to make room (503). Clients that exceed
+    their token bucket get a 429. Both carry a Retry-After.
+    """
+    def __init__(
+        self,
+        workers = ADMISSION_WORKERS,
+        reserved = ADMISSION_RESERVED,
+        backlog = ADMISSION_BACKLOG,
+        rate = CLIENT_RATE,
+        burst = CLIENT_BURST
+    ):
+        self.limits = [ workers ] + [ workers - reserved ] * LANE_VOLUME
+        self.backlog = backlog
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Condition()
+        self.running = 0
+        self.queues = [ deque() for _ in self.limits ]
+        # client -> ( tokens, monotonic time of the last refill )
+        self.buckets = {}
+
+    def _take_tokens( self, client, now, count = 1 ):
+        """Seconds until the client may retry, or 0 if it got the tokens."""
+        if self.rate is None or count <= 0:
+            return 0
+        tokens, updated = self.buckets.get( client, ( self.burst, now ) )
+        tokens = min( self.burst, tokens + ( now - updated ) * self.rate )
+        if tokens < count:
+            self.buckets[ client ] = ( tokens, now )
+            return ( count - tokens ) / self.rate
+        self.buckets[ client ] = ( tokens - count, now )
+        if len( self.buckets ) > 1024:
+            # forget clients whose buckets have refilled anyway
+            horizon = now - self.burst / self.rate
+            self.buckets = {
+                key: value
+                for key, value in self.buckets.items()
+                if value[ 1 ] > horizon
+            }
+        return 0
+
+    def _grant( self ):
+        """Admits waiting tickets, most urgent lane first."""
+        for queue, limit in zip( self.queues, self.limits ):
+            while queue and self.running < limit:
+                queue.popleft().state = "admitted"
+                self.running += 1
+        self.lock.notify_all()
+
+    def _make_room( self, lane ):
+        """Sheds the newest ticket of the least urgent lane below lane."""
+        for queue in reversed( self.queues[ lane + 1 : ] ):
+            if queue:
+                queue.pop().state = "shed"
+                # its handler thread is waiting to send the 503
+                self.lock.notify_all()
+                return True
+        return False
+
+    def charge( self, client, count ):
+        """Takes count tokens at once, e.g. for the steps of a batch."""
+        with self.lock:
+            retry_after = self._take_tokens( client, time.monotonic(), count )
+        if retry_after:
+            raise AdmissionRejected( 429, "Too many requests", retry_after )
+
+    def acquire( self, client, lane, charge = True ):
+        with self.lock:
+            now = time.monotonic()
+            if lane != LANE_POWER and charge:
+                retry_after = self._take_tokens( client, now )
+                if retry_after:
+                    raise AdmissionRejected(
+                        429,
+                        "Too many requests",
+                        retry_after
+                    )
+            if self.running < self.limits[ lane ] and not any(
+                self.queues[ : lane + 1 ]
+            ):
+                self.running += 1
+                return
+            waiting = sum( len( queue ) for queue in self.queues )
+            if waiting >= self.backlog and not self._make_room( lane ):
+                raise AdmissionRejected( 503, "Server busy", 1 )
+            ticket = AdmissionTicket()
+            self.queues[ lane ].append( ticket )
+            deadline = now + ADMISSION_WAIT[ lane ]
+            while ticket.state == "waiting":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.queues[ lane ].remove( ticket )
+                    raise AdmissionRejected( 503, "Timed out in queue", 1 )
+                self.lock.wait( remaining )
+            if ticket.state == "shed":
+                raise AdmissionRejected(
+                    503,
+                    "Shed for a more urgent request",
+                    1
+                )
+
+    def release( self ):
+        with self.lock:
+            self.running -= 1
+            self._grant()
+
+    @contextmanager
+    def slot( self, client, lane, charge = True ):
+        """Runs the body once admitted; raises AdmissionRejected if not."""
+        self.acquire( client, lane, charge )
+        try:
+            yield
+        finally:
+            self.release()
+
+
 class BraviaHandler( BaseHTTPRequestHandler ):
-    def _send_json( self, code, body ):
-        self.send_response( code )
-        self.send_header( "Content-Type", "application/json" )
-        self.end_headers()
-        self.wfile.write( json.dumps( body ).encode() )
+    # Persistent connections: clients reuse one socket for many requests
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+    disable_nagle_algorithm = True
+    # status code -> status line and fixed headers, built once per code
+    _header_blocks = {}
+    # ( second, b"Date: ...\r\n" ), refreshed at most once a second
+    _date_header = ( 0, b"" )
 
-    def do_GET( self ):
-        slug = self.path.strip( "/" ).replace( ".", "" ).casefold()
-        ctrl = MediaController()
-        wake_on_lan( TV_MAC )
+    def _header_block( self, code ):
+        block = BraviaHandler._header_blocks.get( code )
+        if block is None:
+            block = (
+                f"{self.protocol_version} {code} {HTTPStatus( code ).phrase}\r\n"
+                f"Server: {self.version_string()}\r\n"
+                "Content-Type: application/json\r\n"
+            ).encode( "latin-1" )
+            BraviaHandler._header_blocks[ code ] = block
+        return block
+
+    def _date_block( self ):
+        now = int( time.time() )
+        second, block = BraviaHandler._date_header
+        if second != now:
+            block = f"Date: {formatdate( now, usegmt = True )}\r\n".encode()
+            BraviaHandler._date_header = ( now, block )
+        return block
+
+    def _send_json( self, code, body, retry_after = None ):
+        payload = JSON_ENCODER.encode( body ).encode()
+        retry_block = b"" if retry_after is None else (
+            b"Retry-After: %d\r\n" % math.ceil( retry_after )
+        )
+        self.log_request( code )
+        self.wfile.write(
+            b"".join(
+                (
+                    self._header_block( code ),
+                    self._date_block(),
+                    b"Content-Length: %d\r\n" % len( payload ),
+                    retry_block,
+                    b"Connection: close\r\n" if self.close_connection else b"",
+                    b"\r\n",
+                    payload
+                )
+            )
+        )
+
+    def _stream_events( self, rooms ):
+        """Server-sent events until the client goes away."""
+        hub = self.server.hub
+        subscriber = hub.subscribe( rooms )
+        self.close_connection = True
+        try:
+            self.send_response( 200 )
+            self.send_header( "Content-Type", "text/event-stream" )
+            self.send_header( "Cache-Control", "no-cache" )
+            self.send_header( "Connection", "close" )
+            self.end_headers()
+            self.wfile.write(
+                encode_event( "snapshot",
+                              hub.snapshot( rooms ) )
+            )
+            last_write = time.monotonic()
+            while True:
+                events = subscriber.drain( EVENT_LIVENESS )
+                if events is None:
+                    events = [
+                        encode_event( "snapshot",
+                                      hub.snapshot( rooms ) )
+                    ]
+                elif not events:
+                    if self._client_gone():
+                        break
+                    if time.monotonic() - last_write < EVENT_HEARTBEAT:
+                        continue
+                    events = [ b": heartbeat\n\n" ]
+                self.wfile.write( b"".join( events ) )
+                last_write = time.monotonic()
+        except OSError:
+            pass
+        finally:
+            hub.unsubscribe( subscriber )
+
+    def _client_gone( self ):
+        """An SSE client sends nothing after its request, so EOF is hang-up."""
+        readable, _, _ = select.select( [ self.connection ], [], [], 0 )
+        if not readable:
+            return False
+        return not self.connection.recv( 1, socket.MSG_PEEK )
+
+    def _respond( self, lane, route, *args, nudge = False ):
+        """
+        Runs route( *args ) in the given admission lane and sends its
+        result. nudge: the route can change TV state, so the /events
+        poller should look again if it succeeds.
+        """
+        started = time.time()
+        retry_after = None
         try:
-            if slug.startswith( "tvpower" ):
-                action = slug.replace( "tvpower", "" )
-                status_resp = ctrl.tv_req( 'system', 'getPowerStatus' )
-                status = ( status_resp or
-                           {} ).get( 'result',
-                                     [ {} ] )[ 0 ].get( 'status' )
-                power_req = {
-                    "send": False,
-                    "service": "system",
-                    "method": "setPowerStatus",
-                    "params": {}
+            if lane is None:
+                # a macro or batch; _run_steps admits each step
+                code, body = route( *args )
+            else:
+                with self.server.admission.slot(
+                    self.client_address[ 0 ],
+                    lane
+                ):
+                    code, body = route( *args )
+        except AdmissionRejected as e:
+            logger.warning(
+                f"{self.path} from {self.client_address[ 0 ]}: {e}"
+            )
+            code, body = e.code, {
+                "error": str( e )
+            }
+            retry_after = e.retry_after
+        except OSError as e:
+            logger.warning( f"{self.path} failed: {e}" )
+            code, body = 500, {
+                "error": str( e )
+            }
+        if retry_after is None and code in ( 429, 503 ):
+            # e.g. a batch whose steps were shed
+            retry_after = 1
+        self._send_json( code, body, retry_after )
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record(
+                'http',
+                {
+                    "method": self.command,
+                    "path": self.path,
+                    "body": self.body
+                },
+                response = code,
+                started = started,
+                duration = time.time() - started
+            )
+        if nudge and 200 <= code < 300:
+            self.server.hub.nudge()
+
+    def _route( self, devices, slug, scope ):
+        registry = self.server.registry
+        if scope is None and slug.startswith( "frontendswitch" ):
+            return self.server.frontends.switch(
+                slug[ len( "frontendswitch" ): ] or None
+            )
+        if slug.startswith( "macro" ):
+            name = slug[ len( "macro" ): ]
+            if name not in registry.macros:
+                return 404, {
+                    "error": f"Unknown macro: {name}"
                 }
-                input_req = {
-                    "send": False,
-                    "service": "avContent",
-                    "method": "setPlayContent",
+            return self._run_steps( registry.macros[ name ], devices, scope )
+        if scope == ALL_DEVICES:
+            return registry.fan_out( devices, slug )
+        return handle_request( devices[ 0 ], slug )
+
+    def _batch( self, devices, scope ):
+        """POST /batch: a JSON list of route paths, or {"steps": [...]}."""
+        try:
+            steps = json.loads( self.body or "null" )
+        except ValueError as e:
+            return 400, {
+                "error": f"Invalid JSON: {e}"
+            }
+        if isinstance( steps, dict ):
+            steps = steps.get( "steps" )
+        if not isinstance( steps, list ):
+            return 400, {
+                "error": "Expected a list of steps"
+            }
+        return self._run_steps( steps, devices, scope )
+
+    def _run_steps( self, steps, devices, scope ):
+        """
+        Charges the client a token per step up front, then admits every
+        step in its own lane, so a batch cannot get around the rate limit
+        or carry volume presses in a more urgent lane.
+        """
+        registry = self.server.registry
+        admission = self.server.admission
+        client = self.client_address[ 0 ]
+        error = registry.check_steps( steps )
+        if error:
+            return 400, {
+                "error": error
+            }
+        admission.charge(
+            client,
+            sum(
+                route_lane( registry.resolve( step )[ 1 ] ) != LANE_POWER
+                for step in steps
+            )
+        )
+        return run_steps(
+            registry,
+            steps,
+            devices,
+            scope,
+            partial( admission.slot,
+                     client,
+                     charge = False )
+        )
+
+    def do_GET( self ):
+        self.body = None
+        devices, slug, scope = self.server.registry.resolve( self.path )
+        if slug == "events":
+            self._stream_events(
+                None if scope in ( None,
+                                   ALL_DEVICES ) else { scope }
+            )
+            return
+        self._respond(
+            route_lane( slug ),
+            self._route,
+            devices,
+            slug,
+            scope,
+            nudge = changes_state( slug )
+        )
+
+    def do_POST( self ):
+        # always drain the body, or it would be read as the next request
+        length = int( self.headers.get( "Content-Length" ) or 0 )
+        self.body = self.rfile.read( length ).decode(
+            errors = "replace"
+        ) if length > 0 else None
+        devices, slug, scope = self.server.registry.resolve( self.path )
+        if slug == "batch":
+            self._respond( None, self._batch, devices, scope, nudge = True )
+        else:
+            self._respond(
+                route_lane( slug ),
+                self._route,
+                devices,
+                slug,
+                scope,
+                nudge = changes_state( slug )
+            )
+
+
+class BraviaHTTPServer( ThreadingHTTPServer ):
+    # a burst should reach admission control and get a 429/503, rather
+    # than overflow the kernel's accept queue and stall on SYN retries
+    request_queue_size = 128
+
+
+def tv_power( ctrl, action ):
+    device = ctrl.device
+    status_resp = ctrl.tv_req( 'system', 'getPowerStatus' )
+    status = ( status_resp or {} ).get( 'result',
+                                        [ {} ] )[ 0 ].get( 'status' )
+    power_req = {
+        "send": False,
+        "service": "system",
+        "method": "setPowerStatus",
+        "params": {}
+    }
+    input_req = {
+        "send": False,
+        "service": "avContent",
+        "method": "setPlayContent",
+        "params": {
+            "uri": f"extInput:hdmi?port={device.tv_hdmi_port}"
+        }
+    }
+    if action in [ "control", "toggle" ]:
+        if status == "active":
+            power_req.update(
+                {
+                    "send": True,
                     "params": {
-                        "uri": f"extInput:hdmi?port={TV_HDMI_PORT}"
-                    }
+                        "status": False
+                    },
+                    "side_effect": ctrl.kodi_stop
                 }
-                if action in [ "control", "toggle" ]:
-                    if status == "active":
-                        power_req.update(
-                            {
-                                "send": True,
-                                "params": {
-                                    "status": False
-                                },
-                                "side_effect": ctrl.kodi_stop
-                            }
-                        )
-                    else:
-                        power_req.update(
-                            {
-                                "send": True,
-                                "params": {
-                                    "status": True
-                                }
-                            }
-                        )
-                        input_req[ "send" ] = True
-                elif action == "on":
-                    if status != "active":
-                        power_req.update(
-                            {
-                                "send": True,
-                                "params": {
-                                    "status": True
-                                }
-                            }
-                        )
-                    try:
-                        hdmi_resp = ctrl.tv_req(
-                            'avContent',
-                            'getPlayingContentInfo'
-                        )
-                        current_hdmi = ( hdmi_resp or
-                                         {} ).get( 'result',
-                                                   [ {}
-                                                    ] )[ 0 ].get( 'uri',
-                                                                  '' )
-                        if current_hdmi != input_req[ "params" ][ "uri" ]:
-                            input_req[ "send" ] = True
-                    except:
-                        input_req[ "send" ] = True
-                elif action == "off":
-                    if status == "active":
-                        power_req.update(
-                            {
-                                "send": True,
-                                "params": {
-                                    "status": False
-                                },
-                                "side_effect": ctrl.kodi_stop
-                            }
-                        )
-                    else:
-                        ctrl.kodi_stop()
-                results = []
-                for req in [ power_req, input_req ]:
-                    if req[ "send" ]:
-                        if "side_effect" in req:
-                            req[ "side_effect" ]()
-                        res = ctrl.tv_req(
-                            req[ "service" ],
-                            req[ "method" ],
-                            req[ "params" ]
-                        )
-                        results.append( res )
-                self._send_json(
-                    200,
-                    {
-                        "prev_status": status,
-                        "results": results
-                    }
-                )
-            elif slug in [ "tvvolumeup", "tvvolumedown", "tvvolumemute" ]:
-                action_map = {
-                    "tvvolumeup": "vol_up",
-                    "tvvolumedown": "vol_down",
-                    "tvvolumemute": "vol_mute"
+            )
+        else:
+            power_req.update( {
+                "send": True,
+                "params": {
+                    "status": True
                 }
-                key = action_map[ slug ]
-                logger.info( f"TV volume: {key}" )
-                body = ctrl.tv_ircc( key )
-                self._send_json( 200, body )
-            elif slug == "onscreensaveractivated":
-                logger.info( "OnScreenSaver activated: sending TV power-off" )
-                body = ctrl.tv_req(
-                    'system',
-                    'setPowerStatus',
-                    {
+            } )
+            input_req[ "send" ] = True
+    elif action == "on":
+        if status != "active":
+            power_req.update( {
+                "send": True,
+                "params": {
+                    "status": True
+                }
+            } )
+        # as cheap as asking which input is on, and the remote may have
+        # changed it behind our back
+        input_req[ "send" ] = True
+    elif action == "off":
+        if status == "active":
+            power_req.update(
+                {
+                    "send": True,
+                    "params": {
                         "status": False
-                    }
-                )
-                self._send_json( 200, body )
+                    },
+                    "side_effect": ctrl.kodi_stop
+                }
+            )
+        else:
+            ctrl.kodi_stop()
+    response = {
+        "prev_status": status
+    }
+    # only the cached capabilities: discovery could stall a power-on
+    caps = device.capabilities
+    uri = input_req[ "params" ][ "uri" ]
+    if input_req[ "send" ] and caps and caps.inputs and uri not in caps.inputs:
+        logger.warning(
+            f"{device.name}: tv_hdmi_port {device.tv_hdmi_port} is not an "
+            f"input of this TV, not switching input"
+        )
+        input_req[ "send" ] = False
+        response[ "input_error" ] = (
+            f"TV has no HDMI {device.tv_hdmi_port} input"
+        )
+    results = []
+    for req in [ power_req, input_req ]:
+        if req[ "send" ]:
+            if "side_effect" in req:
+                req[ "side_effect" ]()
+            res = ctrl.tv_req(
+                req[ "service" ],
+                req[ "method" ],
+                req[ "params" ]
+            )
+            results.append( res )
+    response[ "results" ] = results
+    return 200, response
+
+
+# volume key -> relative setAudioVolume step, where the TV supports it
+VOLUME_STEPS = {
+    "vol_up": "+1",
+    "vol_down": "-1"
+}
+
+
+def tv_volume( ctrl, key ):
+    logger.info( f"{ctrl.device.name}: TV volume: {key}" )
+    caps = ctrl.capabilities()
+    if key in VOLUME_STEPS and caps.supports( 'audio', 'setAudioVolume' ):
+        return 200, ctrl.tv_req(
+            'audio',
+            'setAudioVolume',
+            {
+                "target": "speaker",
+                "volume": VOLUME_STEPS[ key ]
+            }
+        )
+    return 200, ctrl.tv_ircc( key )
+
+
+def tv_set_volume( ctrl, level ):
+    caps = ctrl.capabilities()
+    if caps.versions and not caps.supports( 'audio', 'setAudioVolume' ):
+        return 501, {
+            "error": "TV cannot set an absolute volume"
+        }
+    low, high = caps.volume.get( "speaker", ( 0, 100 ) )
+    level = min( max( int( level ), low ), high )
+    logger.info( f"{ctrl.device.name}: TV volume: {level}" )
+    return 200, ctrl.tv_req(
+        'audio',
+        'setAudioVolume',
+        {
+            "target": "speaker",
+            "volume": str( level )
+        }
+    )
+
+
+def tv_input( ctrl, port ):
+    uri = f"extInput:hdmi?port={port}"
+    caps = ctrl.capabilities()
+    if caps.inputs and uri not in caps.inputs:
+        return 404, {
+            "error": f"TV has no HDMI {port} input"
+        }
+    logger.info( f"{ctrl.device.name}: TV input: HDMI {port}" )
+    body = ctrl.tv_req( 'avContent',
+                        'setPlayContent',
+                        {
+                            "uri": uri
+                        } )
+    return 200, body
+
+
+def screensaver_activated( ctrl ):
+    logger.info(
+        f"{ctrl.device.name}: OnScreenSaver activated: sending TV power-off"
+    )
+    return 200, ctrl.tv_req(
+        'system',
+        'setPowerStatus',
+        {
+            "status": False
+        }
+    )
+
+
+def screensaver_deactivated( ctrl ):
+    logger.info(
+        f"{ctrl.device.name}: OnScreenSaver deactivated: sending TV power-on"
+    )
+    return tv_power( ctrl, "on" )
+
+
+# slug -> handler( ctrl ), built once; parametric routes are matched below
+ROUTES = {
+    "onscreensaveractivated": screensaver_activated,
+    "onscreensaverdeactivated": screensaver_deactivated,
+    "tvvolumeup": partial( tv_volume,
+                           key = "vol_up" ),
+    "tvvolumedown": partial( tv_volume,
+                             key = "vol_down" ),
+    "tvvolumemute": partial( tv_volume,
+                             key = "vol_mute" )
+}
+# a bare /tvpower only reports the power status
+for action in ( "", "control", "toggle", "on", "off" ):
+    ROUTES[ "tvpower" + action ] = partial( tv_power, action = action )
+# ( pattern, handler( ctrl, *groups ) )
+PATTERN_ROUTES = (
+    ( re.compile( r"tvinputhdmi(\d)" ),
+      tv_input ),
+    ( re.compile( r"tvvolume(\d{1,3})" ),
+      tv_set_volume ),
+)
+
+
+def find_route( slug ):
+    """Returns ( handler, args ), or ( None, () ) for an unknown slug."""
+    handler = ROUTES.get( slug )
+    if handler is not None:
+        return handler, ()
+    for pattern, handler in PATTERN_ROUTES:
+        match = pattern.fullmatch( slug )
+        if match:
+            return handler, match.groups()
+    return None, ()
+
+
+def handle_request( device, slug, expires = None ):
+    """
+    Runs one route against one device, returning ( code, body ). With
+    expires (a monotonic time), a command that cannot start by then is
+    not run at all: its caller has already reported it as timed out.
+    """
+    handler, args = find_route( slug )
+    if handler is None:
+        return 404, {
+            "error": f"Unknown route: {slug}"
+        }
+    ctrl = MediaController( device )
+    timeout = None if expires is None else max( 0, expires - time.monotonic() )
+    if not device.command_lock.acquire( route_lane( slug ), timeout ):
+        return 504, {
+            "error": "Deadline exceeded"
+        }
+    try:
+        wake_on_lan( device.tv_mac )
+        return handler( ctrl, *args )
+    except ( BraviaTVError, requests.RequestException ) as e:
+        logger.warning( f"{device.name}: TV request failed: {e}" )
+        return 502, {
+            "error": str( e )
+        }
+    finally:
+        device.command_lock.release()
+
+
+def dispatch( registry, path, devices = None, scope = None ):
+    """
+    Runs a route path against the devices it names. Unscoped paths fall
+    back to the given devices/scope (e.g. those a macro was called for).
+    """
+    path_devices, slug, path_scope = registry.resolve( path )
+    if path_scope is not None or devices is None:
+        devices, scope = path_devices, path_scope
+    if scope == ALL_DEVICES:
+        return registry.fan_out( devices, slug )
+    return handle_request( devices[ 0 ], slug )
+
+
+def combined_status( codes ):
+    """
+    The status of several results (batch steps, fan-out devices): 502 if
+    a TV failed, else that of the first one that did not succeed.
+    """
+    if any( code in UPSTREAM_ERRORS for code in codes ):
+        return 502
+    return next( ( code for code in codes if code != 200 ), 200 )
+
+
+def run_steps( registry, steps, devices = None, scope = None, admit = None ):
+    """
+    Runs route paths one after another, with a result per step. Steps are
+    checked up front, so a bad one fails the batch before any TV is
+    touched; combined_status gives the overall status otherwise.
+    admit( lane ), if given, is a context manager that admits each step.
+    """
+    error = registry.check_steps( steps )
+    if error:
+        return 400, {
+            "error": error
+        }
+    results = []
+    for step in steps:
+        try:
+            if admit is None:
+                code, body = dispatch( registry, step, devices, scope )
             else:
-                self.send_response( 404 )
-                self.end_headers()
-        except ( BraviaTVError, requests.RequestException ) as e:
-            logger.warning( f"TV request failed: {e}" )
-            self._send_json( 502,
-                             {
-                                 "error": str( e )
-                             } )
+                with admit( route_lane( registry.resolve( step )[ 1 ] ) ):
+                    code, body = dispatch( registry, step, devices, scope )
+        except AdmissionRejected as e:
+            code, body = e.code, {
+                "error": str( e )
+            }
+        results.append( {
+            "step": step,
+            "status": code,
+            "body": body
+        } )
+    return combined_status( [ result[ "status" ] for result in results ] ), {
+        "steps": results
+    }
+
+
+class DatagramListener:
+    """
+    Receives event datagrams (see event_protocol.py) on a UDP port or a
+    Unix socket and runs them like the equivalent GET /<room>/<route>,
+    without an HTTP round trip. Events are handled one at a time, in the
+    order they arrive, so a power-off and power-on cannot overtake each
+    other; the socket buffers whatever arrives meanwhile.
+    """
+    def __init__( self, server, url ):
+        self.server = server
+        family, address = parse_address( url )
+        if family == socket.AF_UNIX and os.path.lexists( address ):
+            if not stat.S_ISSOCK( os.lstat( address ).st_mode ):
+                raise RuntimeError(
+                    f"{address} exists and is not a socket; not replacing it"
+                )
+            # left behind by a previous run
+            os.unlink( address )
+        self.sock = socket.socket( family, socket.SOCK_DGRAM )
+        self.sock.bind( address )
+        self.url = url
+
+    def serve_forever( self ):
+        while True:
+            try:
+                datagram, sender = self.sock.recvfrom( 256 )
+            except OSError as e:
+                # rare (e.g. an ICMP error on UDP); pause rather than spin
+                logger.warning( f"Event socket receive failed: {e}" )
+                time.sleep( 1 )
+                continue
+            received = time.time()
+            try:
+                route, room = decode_event( datagram )
+            except ValueError as e:
+                logger.warning( f"Dropped datagram from {sender}: {e}" )
+                continue
+            path = f"/{room}/{route}" if room else f"/{route}"
+            try:
+                self._handle( path, received )
+            except Exception:
+                # the socket stays bound, so a dead listener would lose
+                # every later event without the sender noticing
+                logger.exception( f"Datagram event {path} failed" )
+
+    def _handle( self, path, started ):
+        _, slug, _ = self.server.registry.resolve( path )
+        try:
+            with self.server.admission.slot( "datagram", route_lane( slug ) ):
+                code, _ = dispatch( self.server.registry, path )
+        except AdmissionRejected as e:
+            logger.warning( f"{path}: {e}" )
+            code = e.code
+        except OSError as e:
+            logger.warning( f"{path} failed: {e}" )
+            code = 500
+        logger.info( f"Datagram event {path}: {code}" )
+        recorder = get_recorder()
+        if recorder is not None:
+            # replayed over HTTP, which runs the same route
+            recorder.record(
+                'http',
+                {
+                    "method": "GET",
+                    "path": path,
+                    "body": None
+                },
+                response = code,
+                started = started,
+                duration = time.time() - started,
+                transport = "datagram"
+            )
+        if changes_state( slug ) and 200 <= code < 300:
+            self.server.hub.nudge()
 
 
 if __name__ == "__main__":
-    server = HTTPServer( ( '0.0.0.0', SERVER_PORT ), BraviaHandler )
-    logger.info( f"Bravia-Kodi API Server listening on port {SERVER_PORT}" )
+    # Strict Configuration - No defaults, no startup without these
+    try:
+        registry = load_registry()
+        SERVER_PORT = int( get_env_strict( 'SERVER_PORT' ) )
+        if os.environ.get( 'BRAVIA_TRACE' ):
+            set_recorder( TraceRecorder( os.environ[ 'BRAVIA_TRACE' ] ) )
+            # what a replay needs to rebuild the devices, minus secrets
+            for device in registry.devices.values():
+                get_recorder().record(
+                    'device',
+                    {
+                        "name": device.name,
+                        "tv_hdmi_port": device.tv_hdmi_port,
+                        "default": device.name == registry.default
+                    }
+                )
+            get_recorder().record( 'macros', registry.macros )
+        server = BraviaHTTPServer( ( '0.0.0.0', SERVER_PORT ), BraviaHandler )
+        # optional low-latency transport, next to HTTP
+        listener = DatagramListener(
+            server,
+            os.environ[ 'EVENT_SOCKET' ]
+        ) if os.environ.get( 'EVENT_SOCKET' ) else None
+    except ( RuntimeError, ValueError, OSError ) as e:
+        print( f"Server failed to start: {e}", file = sys.stderr )
+        sys.exit( 1 )
+    server.registry = registry
+    server.hub = StateHub( registry )
+    server.admission = AdmissionController()
+    for device in registry.devices.values():
+        registry.executor.submit( MediaController( device ).discover )
+    server.frontends = FrontendSupervisor(
+        {
+            name:
+                shlex.split(
+                    os.environ.get( f"FRONTEND_{name.upper()}_CMD",
+                                    command )
+                )
+            for name, ( command, _ ) in FRONTENDS.items()
+        }
+    )
+    if listener is not None:
+        threading.Thread( target = listener.serve_forever,
+                          daemon = True ).start()
+        logger.info( f"Listening for event datagrams on {listener.url}" )
+    logger.info(
+        f"Bravia-Kodi API Server listening on port {SERVER_PORT} "
+        f"for rooms: {', '.join( registry.devices )}"
+    )
     server.serve_forever()
@@ -1,9 +1,12 @@
 import json
 import os
+import time
 
 import xbmc
 
+from journal import journal
 from logger import Logger
+from rpc_trace import get_recorder
 
 
 class KodiJSONRPCError( Exception ):
@@ -24,13 +27,27 @@ def json_rpc( **kwargs ):
         # only show if debug mode
         logger.log( 'JSON-RPC execute %s' % payload, xbmc.LOGDEBUG )
         # Execute RPC call
+        started = time.time()
         response_str = xbmc.executeJSONRPC( payload )
+        duration = time.time() - started
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record(
+                'json_rpc',
+                kwargs,
+                response = response_str,
+                started = started,
+                duration = duration
+            )
+        event = 'rpc:%s' % kwargs.get( 'method' )
         if not response_str:
+            journal.add( event, 'empty', duration, timestamp = started )
             logger.log( 'Empty response from JSON-RPC', xbmc.LOGERROR )
             raise KodiJSONRPCError( 'Empty response from JSON-RPC' )
         try:
             output = json.loads( response_str )
         except ValueError as e:
+            journal.add( event, 'invalid', duration, timestamp = started )
             logger.log(
                 'Failed to parse JSON-RPC response: %s' % str( e ),
                 xbmc.LOGERROR
@@ -47,9 +64,17 @@ def json_rpc( **kwargs ):
                 error_info.get( 'code',
                                 'Unknown' )
             )
+            journal.add(
+                event,
+                'error',
+                duration,
+                error_info.get( 'code' ),
+                timestamp = started
+            )
             logger.log( error_msg, xbmc.LOGERROR )
             logger.log( 'Full error: %s' % error_info, xbmc.LOGERROR )
             raise KodiJSONRPCError( error_msg, error_info )
+        journal.add( event, 'ok', duration, timestamp = started )
         result = output.get( 'result',
                              {} )
         return result
@@ -0,0 +1,107 @@
+import socket
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+# magic, protocol version, event id; an optional UTF-8 room name follows
+__HEADER__ = struct.Struct( '!2sBB' )
+__MAGIC__ = b'ZU'
+__VERSION__ = 1
+# event id - 1 -> bravia_server route; new events are only ever appended
+__EVENTS__ = (
+    'onscreensaveractivated',
+    'onscreensaverdeactivated',
+    'tvpoweron',
+    'tvpoweroff',
+)
+__MAX_ROOM__ = 64
+# after a failed send, datagrams are not tried again for this many seconds
+__RETRY_AFTER__ = 60
+
+
+def parse_address( url ):
+    """
+    udp://host:port or unix:///path/to/socket -> ( family, address ).
+    Raises ValueError for anything else.
+    """
+    parts = urlsplit( url.strip() )
+    if parts.scheme == 'udp' and parts.hostname and parts.port:
+        return socket.AF_INET, ( parts.hostname, parts.port )
+    if parts.scheme == 'unix' and parts.path:
+        return socket.AF_UNIX, parts.path
+    raise ValueError( 'Unsupported event address: %s' % url )
+
+
+def encode_event( event, room = '' ):
+    """Packs an event name (any case) into a datagram."""
+    event_id = __EVENTS__.index( event.casefold() ) + 1
+    room = room.encode( 'utf-8' )
+    if len( room ) > __MAX_ROOM__:
+        raise ValueError( 'Room name too long' )
+    return __HEADER__.pack( __MAGIC__, __VERSION__, event_id ) + room
+
+
+def decode_event( datagram ):
+    """A datagram -> ( route, room ); raises ValueError if malformed."""
+    if len( datagram ) < __HEADER__.size or (
+        len( datagram ) > __HEADER__.size + __MAX_ROOM__
+    ):
+        raise ValueError( 'Bad datagram length: %d' % len( datagram ) )
+    magic, version, event_id = __HEADER__.unpack_from( datagram )
+    if magic != __MAGIC__ or version != __VERSION__:
+        raise ValueError( 'Not an event datagram' )
+    if not 0 < event_id <= len( __EVENTS__ ):
+        raise ValueError( 'Unknown event id: %d' % event_id )
+    room = datagram[ __HEADER__.size : ].decode( 'utf-8' )
+    return __EVENTS__[ event_id - 1 ], room
+
+
+class EventSender:
+    """
+    Sends event datagrams over one reusable socket. Delivery is not
+    acknowledged; a send that fails raises OSError so the caller can fall
+    back to HTTP, and so does every send for __RETRY_AFTER__ seconds after
+    that, rather than reconnecting straight away.
+
+    A Unix socket reports a missing listener on the send itself. UDP only
+    learns of it from an ICMP error surfacing on the *next* send, so the
+    first event after a UDP listener goes away is lost; prefer unix://
+    when both ends are on the same machine.
+    """
+    def __init__( self, url ):
+        self.family, self.address = parse_address( url )
+        self.lock = threading.Lock()
+        self.sock = None
+        self.down_until = 0
+
+    def send( self, event, room = '' ):
+        datagram = encode_event( event, room )
+        with self.lock:
+            if time.monotonic() < self.down_until:
+                raise ConnectionRefusedError( 'Event socket marked down' )
+            try:
+                self._send( datagram )
+            except OSError:
+                self.down_until = time.monotonic() + __RETRY_AFTER__
+                raise
+
+    def _send( self, datagram ):
+        if self.sock is None:
+            self.sock = socket.socket( self.family, socket.SOCK_DGRAM )
+            try:
+                self.sock.connect( self.address )
+            except OSError:
+                self.close()
+                raise
+        try:
+            self.sock.send( datagram )
+        except OSError:
+            # a fresh socket next time, e.g. once the server is back
+            self.close()
+            raise
+
+    def close( self ):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,69 @@
+import time
+from collections import deque
+
+__JOURNAL_CAPACITY__ = 256
+
+
+class JournalEntry:
+    __slots__ = ( 'event', 'timestamp', 'duration', 'outcome', 'detail' )
+
+    def __init__( self, event, timestamp, duration, outcome, detail ):
+        self.event = event
+        self.timestamp = timestamp
+        self.duration = duration
+        self.outcome = outcome
+        self.detail = detail
+
+    def format( self ):
+        stamp = time.strftime(
+            '%Y-%m-%d %H:%M:%S',
+            time.localtime( self.timestamp )
+        )
+        line = '%s.%03d %-36s %8.1fms %-8s %s' % (
+            stamp,
+            int( self.timestamp * 1000 ) % 1000,
+            self.event,
+            self.duration * 1000,
+            self.outcome,
+            '' if self.detail is None else self.detail
+        )
+        return line.rstrip()
+
+
+class Journal:
+    """
+    Fixed-size ring buffer of compact event records. Old entries fall off
+    the end, so it can stay on permanently without the cost of verbose
+    logging; dump() writes it out when something needs diagnosing.
+    """
+    def __init__( self, capacity = __JOURNAL_CAPACITY__ ):
+        # deque.append is atomic, callbacks may come from several threads
+        self.entries = deque( maxlen = capacity )
+
+    def add(
+        self,
+        event,
+        outcome = 'ok',
+        duration = 0.0,
+        detail = None,
+        timestamp = None
+    ):
+        self.entries.append(
+            JournalEntry(
+                event,
+                time.time() if timestamp is None else timestamp,
+                duration,
+                outcome,
+                detail
+            )
+        )
+
+    def dump( self, path ):
+        entries = list( self.entries )
+        with open( path, 'w', encoding = 'utf-8' ) as f:
+            for entry in entries:
+                f.write( entry.format() + '\n' )
+        return len( entries )
+
+
+journal = Journal()
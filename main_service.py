@@ -1,11 +1,20 @@
+import json
 import os
+import time
 
-import xbmc, xbmcaddon
+import xbmc, xbmcaddon, xbmcvfs
 
 from common import ( get_player_id, json_rpc, KodiJSONRPCError )
+from journal import journal
 from logger import Logger
 from monitor import Monitor
 from player import Player
+from rpc_trace import (
+    get_recorder,
+    record_callback,
+    set_recorder,
+    TraceRecorder
+)
 from webhook_service import WebhookControl
 
 
@@ -13,10 +22,23 @@ class MainService( Logger ):
     __SETTING_LOG_MODE_BOOL__ = "debug"
     __SETTING_PREFERRED_LANGUAGE__ = "preferred_language"
     __SETTING_WEBHOOK_URL__ = "webhook_url"
+    __SETTING_EVENT_SOCKET__ = "event_socket"
+    __SETTING_TRACE_RPC_BOOL__ = "trace_rpc"
+    __TRACE_FILE__ = "rpc_trace.jsonl"
+    __JOURNAL_FILE__ = "journal.log"
+    # how long after onAVStarted late-arriving tracks are still honoured
+    __AV_CHANGE_WINDOW__ = 30
+    # the earliest signs of user activity after the screensaver or DPMS
+    __WAKE_NOTIFICATIONS__ = (
+        'GUI.OnScreensaverDeactivated',
+        'GUI.OnDPMSDeactivated'
+    )
 
     def __init__( self ):
         try:
             self.addon = xbmcaddon.Addon()
+            self.av_started_at = None
+            self.stream_signature = None
             self.monitor = Monitor(
                 reloadAction = self.onSettingsChanged,
                 screensaverAction = self.onScreensaverActivated,
@@ -33,7 +55,10 @@ class MainService( Logger ):
             )
             webhook_settings_valid = self.refresh_settings()
             if webhook_settings_valid:
-                self.webhook_control = WebhookControl( self.webhook_url )
+                self.webhook_control = WebhookControl(
+                    self.webhook_url,
+                    self.event_socket
+                )
             else:
                 self.webhook_control = None
                 self.log(
@@ -48,51 +73,167 @@ class MainService( Logger ):
             raise
 
     def onNotification( self, sender, method, data ):
-        if sender == 'service.zumbrella':
+        record_callback( 'onNotification', sender, method, data )
+        journal.add( 'notify:%s' % method, detail = sender )
+        if sender == 'xbmc' and method == 'Player.OnAVChange':
+            self.onAVChange( data )
+        elif sender == 'xbmc' and method in MainService.__WAKE_NOTIFICATIONS__:
+            # usually delivered before the onScreensaverDeactivated callback
+            try:
+                shutting_down = json.loads( data ).get( 'shuttingdown' )
+            except ( TypeError, ValueError, AttributeError ):
+                shutting_down = False
+            if self.webhook_control is None:
+                pass
+            elif shutting_down:
+                # the power-off key ended the screensaver; keep the TV off
+                self.webhook_control.hold_wake( method )
+            else:
+                self.webhook_control.wake( method )
+        elif sender == 'service.zumbrella':
+            # For some reason, the method is prefixed with "Other."
+            method = method.replace( 'Other.', '' )
+            if method == 'dumpJournal':
+                self.dump_journal()
+                return
             if self.webhook_control is None:
                 self.log(
                     'Webhook control not available (settings not configured)',
                     xbmc.LOGDEBUG
                 )
                 return
-            # For some reason, the method is prefixed with "Other."
-            method = method.replace( 'Other.', '' )
-            self.webhook_control.run( method, data )
+            self.webhook_control.run( method )
 
     def onAVStarted( self ):
         self.log( 'onAVStarted' )
+        record_callback( 'onAVStarted' )
+        started = time.time()
+        self.av_started_at = time.monotonic()
+        self.stream_signature = None
+        self.select_streams()
+        journal.add(
+            'onAVStarted',
+            duration = time.time() - started,
+            timestamp = started
+        )
+
+    def onAVChange( self, data ):
+        if self.av_started_at is None:
+            return
+        elapsed = time.monotonic() - self.av_started_at
+        if elapsed > MainService.__AV_CHANGE_WINDOW__:
+            self.log(
+                'onAVChange %.1fs after start, outside window' % elapsed,
+                xbmc.LOGDEBUG
+            )
+            self.av_started_at = None
+            return
+        self.log( 'onAVChange' )
+        started = time.time()
+        player_id = None
         try:
-            self.change_audio_stream()
+            player_id = json.loads( data ).get( 'player',
+                                                {} ).get( 'playerid' )
+        except ( TypeError, ValueError, AttributeError ):
+            pass
+        self.select_streams( player_id )
+        journal.add(
+            'onAVChange',
+            duration = time.time() - started,
+            detail = 'after %.1fs' % elapsed,
+            timestamp = started
+        )
+
+    def select_streams( self, player_id = None ):
+        # fetch both track lists in one call; only (re)select when the
+        # set of tracks differs from what we last acted upon
+        streams = self.get_player_properties(
+            [ 'audiostreams',
+              'subtitles' ],
+            player_id
+        )
+        if streams is None:
+            self.log( 'Streams not available yet, awaiting OnAVChange' )
+            journal.add( 'streams', 'pending' )
+            return
+        signature = self.get_stream_signature( streams )
+        if signature == self.stream_signature:
+            self.log( 'Stream set unchanged, skipping selection' )
+            journal.add( 'streams', 'same' )
+            return
+        self.stream_signature = signature
+        journal.add(
+            'streams',
+            'changed',
+            detail = '%d audio, %d subtitles' %
+            ( len( signature[ 0 ] ),
+              len( signature[ 1 ] ) )
+        )
+        try:
+            self.change_audio_stream(
+                audio_streams = streams.get( 'audiostreams' )
+            )
         except Exception as e:
             self.log(
                 'Error in change_audio_stream: %s' % str( e ),
                 xbmc.LOGERROR
             )
         try:
-            self.activate_subtitles()
+            self.activate_subtitles( subtitles = streams.get( 'subtitles' ) )
         except Exception as e:
             self.log(
                 'Error in activate_subtitles: %s' % str( e ),
                 xbmc.LOGERROR
             )
 
+    @staticmethod
+    def get_stream_signature( streams ):
+        if not isinstance( streams, dict ):
+            return None
+        signature = []
+        for which_property in ( 'audiostreams', 'subtitles' ):
+            items = streams.get( which_property )
+            if not isinstance( items, list ):
+                items = []
+            signature.append(
+                tuple(
+                    (
+                        item.get( 'index' ),
+                        item.get( 'language' ),
+                        item.get( 'name' )
+                    ) for item in items
+                )
+            )
+        return tuple( signature )
+
     def onPlayBackPaused( self ):
         self.log( 'onPlayBackPaused' )
+        journal.add( 'onPlayBackPaused' )
 
     def onPlayBackResumed( self ):
         self.log( 'onPlayBackResumed' )
+        journal.add( 'onPlayBackResumed' )
 
     def onPlayBackEnded( self ):
         self.log( 'onPlayBackEnded' )
+        record_callback( 'onPlayBackEnded' )
+        journal.add( 'onPlayBackEnded' )
+        self.av_started_at = None
 
     def onPlayBackError( self ):
         self.log( 'onPlayBackError' )
+        journal.add( 'onPlayBackError', 'error' )
 
     def onPlayBackStopped( self ):
         self.log( 'onPlayBackStopped' )
+        record_callback( 'onPlayBackStopped' )
+        journal.add( 'onPlayBackStopped' )
+        self.av_started_at = None
 
     def onScreensaverActivated( self ):
         self.log( 'onScreensaverActivated' )
+        record_callback( 'onScreensaverActivated' )
+        journal.add( 'onScreensaverActivated' )
         self.player.stop()
         if self.webhook_control is not None:
             # we use `_off` to indicate turn off; for some reason,
@@ -102,8 +243,10 @@ class MainService( Logger ):
 
     def onScreensaverDeactivated( self ):
         self.log( 'onScreensaverDeactivated' )
+        record_callback( 'onScreensaverDeactivated' )
+        journal.add( 'onScreensaverDeactivated' )
         if self.webhook_control is not None:
-            self.webhook_control.run( 'onScreensaverDeactivated' )
+            self.webhook_control.wake( 'onScreensaverDeactivated' )
 
     def onSettingsChanged( self ):
         Logger.set_log_mode( xbmc.LOGINFO )
@@ -112,7 +255,10 @@ class MainService( Logger ):
         # Recreate bravia_control if settings changed
         if webhook_settings_valid:
             try:
-                self.webhook_control = WebhookControl( self.webhook_url )
+                self.webhook_control = WebhookControl(
+                    self.webhook_url,
+                    self.event_socket
+                )
                 self.log( 'Webhook control reinitialized with new settings' )
             except Exception as e:
                 self.log(
@@ -135,6 +281,10 @@ class MainService( Logger ):
                 MainService.__SETTING_WEBHOOK_URL__
             )
             self.log( 'webhook_url: {}'.format( self.webhook_url ) )
+            self.event_socket = self.addon.getSetting(
+                MainService.__SETTING_EVENT_SOCKET__
+            ).strip()
+            self.log( 'event_socket: {}'.format( self.event_socket ) )
             # Validate Webhook settings (non-critical - service can still run)
             webhook_settings_valid = self.webhook_url and self.webhook_url.strip(
             ),
@@ -146,6 +296,10 @@ class MainService( Logger ):
                 xbmc.executebuiltin(
                     'Notification(Zumbrella Warning, Webhook settings not configured, 5000)'
                 )
+            self.refresh_trace_recorder(
+                self.addon.getSetting( MainService.__SETTING_TRACE_RPC_BOOL__ )
+                == 'true'
+            )
             if not debugMode:
                 self.log( 'Addon going quiet due to debugMode disabled' )
             # When debug mode is ON, use LOGDEBUG (verbose), otherwise LOGINFO (normal)
@@ -157,7 +311,42 @@ class MainService( Logger ):
             Logger.set_log_mode( xbmc.LOGINFO )
             return False
 
-    def activate_subtitles( self, lang = None ):
+    def dump_journal( self ):
+        try:
+            profile = xbmcvfs.translatePath(
+                self.addon.getAddonInfo( 'profile' )
+            )
+            xbmcvfs.mkdirs( profile )
+            path = os.path.join( profile, MainService.__JOURNAL_FILE__ )
+            count = journal.dump( path )
+            self.log( 'Wrote %d journal entries to %s' % ( count, path ) )
+            xbmc.executebuiltin(
+                'Notification(Zumbrella, Journal written to %s, 5000)' % path
+            )
+        except Exception as e:
+            self.log( 'Error dumping journal: %s' % str( e ), xbmc.LOGERROR )
+
+    def refresh_trace_recorder( self, enabled ):
+        if not enabled:
+            set_recorder( None )
+            return
+        if get_recorder() is not None:
+            return
+        try:
+            profile = xbmcvfs.translatePath(
+                self.addon.getAddonInfo( 'profile' )
+            )
+            xbmcvfs.mkdirs( profile )
+            path = os.path.join( profile, MainService.__TRACE_FILE__ )
+            set_recorder( TraceRecorder( path ) )
+            self.log( 'Recording JSON-RPC trace to %s' % path )
+        except Exception as e:
+            self.log(
+                'Could not start JSON-RPC trace: %s' % str( e ),
+                xbmc.LOGERROR
+            )
+
+    def activate_subtitles( self, lang = None, subtitles = None ):
         try:
             if lang is None:
                 lang = self.addon.getSetting(
@@ -166,10 +355,11 @@ class MainService( Logger ):
             self.log(
                 'Activating subtitles with language preference: %s' % lang
             )
-            if not xbmc.getCondVisibility( 'VideoPlayer.HasSubtitles' ):
-                self.log( 'No subtitles available, doing nothing' )
-                return
-            subtitles = self.get_player_properties( 'subtitles' )
+            if subtitles is None:
+                if not xbmc.getCondVisibility( 'VideoPlayer.HasSubtitles' ):
+                    self.log( 'No subtitles available, doing nothing' )
+                    return
+                subtitles = self.get_player_properties( 'subtitles' )
             if subtitles is None:
                 self.log( 'Could not get subtitle properties, doing nothing' )
                 return
@@ -245,8 +435,15 @@ class MainService( Logger ):
                 index = self.pick_appropriate( subtitles, constraints )
             if index is None:
                 self.log( 'No appropriate subtitle found' )
+                journal.add( 'subtitle', 'none', detail = lang )
                 return
             self.log( 'Setting subtitle stream to index %d' % index )
+            journal.add(
+                'subtitle',
+                'set',
+                detail = '#%d of %d' % ( index,
+                                         len( subtitles ) )
+            )
             self.player.setSubtitleStream( index )
             self.log( 'Showing subtitle' )
             self.player.showSubtitles( True )
@@ -261,7 +458,7 @@ class MainService( Logger ):
                 xbmc.LOGERROR
             )
 
-    def change_audio_stream( self, lang = None ):
+    def change_audio_stream( self, lang = None, audio_streams = None ):
         try:
             if lang is None:
                 lang = self.addon.getSetting(
@@ -271,7 +468,8 @@ class MainService( Logger ):
             self.log(
                 'Changing audio stream with language preference: %s' % lang
             )
-            audio_streams = self.get_player_properties( 'audiostreams' )
+            if audio_streams is None:
+                audio_streams = self.get_player_properties( 'audiostreams' )
             if audio_streams is None:
                 self.log(
                     'Could not get audio stream properties, doing nothing'
@@ -301,8 +499,15 @@ class MainService( Logger ):
                 index = self.pick_appropriate( audio_streams, constraints )
             if index is None:
                 self.log( 'No appropriate audio stream found' )
+                journal.add( 'audio_stream', 'none', detail = lang )
                 return
             self.log( 'Setting audio stream to index %d' % index )
+            journal.add(
+                'audio_stream',
+                'set',
+                detail = '#%d of %d' % ( index,
+                                         len( audio_streams ) )
+            )
             self.player.setAudioStream( index )
         except KodiJSONRPCError as e:
             self.log(
@@ -315,22 +520,31 @@ class MainService( Logger ):
                 xbmc.LOGERROR
             )
 
-    def get_player_properties( self, which_property ):
+    def get_player_properties( self, which_property, player_id = None ):
+        # a list of properties returns the whole result dict,
+        # a single property name returns just that property
         try:
             if not xbmc.getCondVisibility( 'Player.HasVideo' ):
                 self.log( 'No video, doing nothing' )
                 return None
-            player_id = get_player_id()
+            if player_id is None or player_id == -1:
+                player_id = get_player_id()
             if player_id == -1:
                 self.log( 'No player_id, cancelled' )
                 return None
+            if isinstance( which_property, list ):
+                properties = which_property
+            else:
+                properties = [ which_property ]
             result = json_rpc(
                 method = 'Player.GetProperties',
                 params = dict(
                     playerid = player_id,
-                    properties = [ which_property ],
+                    properties = properties,
                 )
             )
+            if isinstance( which_property, list ):
+                return result
             return result.get( which_property, [] )
         except KodiJSONRPCError as e:
             self.log(
@@ -1,5 +1,20 @@
 #!/usr/bin/env bash
 
+# bravia_server tracks the frontends it starts, so switching there needs no
+# process table scan; the pgrep logic below is only used when it is down.
+SERVER_URL="${BRAVIA_SERVER_URL:-http://localhost:${SERVER_PORT:-8081}}"
+
+# Above the server's worst case: an admission wait, then SIGTERM and
+# SIGKILL grace periods of five seconds each, then the launch.
+curl -fsS --max-time 30 "$SERVER_URL/frontend/switch"
+STATUS=$?
+# 6/7: the server could not be resolved or connected to. After any other
+# failure (an HTTP error, a timeout) it got the request and may still be
+# switching, so acting here as well could start a second frontend.
+if [ "$STATUS" -ne 6 ] && [ "$STATUS" -ne 7 ]; then
+    exit "$STATUS"
+fi
+
 KODI_PID=$(pgrep -x "kodi.bin")
 PEGASUS_PID=$(pgrep -x "pegasus-fe")
 
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+
+
+class TraceRecorder:
+    """
+    Appends one JSON line per upstream exchange (Kodi JSON-RPC, TV and
+    Kodi calls from bravia_server) or entry point, with its timing, so
+    that trace_replay.py can feed the same traffic back offline.
+    """
+    def __init__( self, path ):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open( path, 'a', encoding = 'utf-8' )
+
+    def record(
+        self,
+        kind,
+        request,
+        response = None,
+        error = None,
+        started = None,
+        duration = 0.0,
+        **extra
+    ):
+        entry = {
+            "kind": kind,
+            "ts": time.time() if started is None else started,
+            "duration": duration,
+            "request": request,
+            "response": response,
+            "error": error
+        }
+        entry.update( extra )
+        line = json.dumps(
+            entry,
+            separators = ( ',',
+                           ':' ),
+            default = str
+        ) + '\n'
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write( line )
+            self.file.flush()
+
+    def close( self ):
+        with self.lock:
+            self.file.close()
+
+
+_recorder = None
+
+
+def get_recorder():
+    return _recorder
+
+
+def set_recorder( recorder ):
+    """Installs the process-wide recorder; None turns recording off."""
+    global _recorder
+    previous, _recorder = _recorder, recorder
+    if previous is not None and previous is not recorder:
+        previous.close()
+
+
+def record_callback( name, *args ):
+    """Records an entry point (e.g. a Kodi callback) for replay."""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record( 'callback',
+                         {
+                             "name": name,
+                             "args": list( args )
+                         } )
+
+
+def load_trace( path ):
+    with open( path, encoding = 'utf-8' ) as f:
+        return [ json.loads( line ) for line in f if line.strip() ]
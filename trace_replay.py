@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Replays a trace recorded by rpc_trace.TraceRecorder offline and reports
+latency distributions per entry point.
+
+    python trace_replay.py bravia bravia_trace.jsonl [--speed 10]
+    python trace_replay.py kodi rpc_trace.jsonl [--speed inf]
+
+Upstream responses (Kodi JSON-RPC, TV and Kodi calls) are served from the
+trace after their recorded duration divided by --speed; the gaps between
+entry points are scaled the same way. --speed inf replays back to back.
+"""
+import argparse
+import http.client
+import json
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict, deque
+
+from rpc_trace import load_trace
+
+
+def percentile( values, fraction ):
+    ordered = sorted( values )
+    if not ordered:
+        return 0.0
+    index = min(
+        len( ordered ) - 1,
+        int( round( fraction * ( len( ordered ) - 1 ) ) )
+    )
+    return ordered[ index ]
+
+
+def report( latencies, recorded = None ):
+    """latencies / recorded: entry point -> list of seconds."""
+    recorded = recorded or {}
+    print(
+        f"{'entry point':<40} {'n':>5} {'p50':>9} {'p90':>9} "
+        f"{'p99':>9} {'max':>9} {'rec p50':>9}"
+    )
+    for name in sorted( latencies ):
+        values = latencies[ name ]
+        original = recorded.get( name )
+        print(
+            f"{name:<40} {len( values ):>5} "
+            f"{percentile( values, 0.5 ) * 1000:>7.1f}ms "
+            f"{percentile( values, 0.9 ) * 1000:>7.1f}ms "
+            f"{percentile( values, 0.99 ) * 1000:>7.1f}ms "
+            f"{max( values ) * 1000:>7.1f}ms " + (
+                f"{percentile( original, 0.5 ) * 1000:>7.1f}ms"
+                if original else f"{'-':>9}"
+            )
+        )
+
+
+class Responder:
+    """
+    Serves recorded upstream responses. Exchanges are matched on kind and
+    request, in recorded order; once a request's recordings run out the
+    last one is reused, so background traffic (e.g. the /events poller)
+    interleaved in the trace does not derail the replay.
+    """
+    def __init__( self, entries, speed, key ):
+        self.speed = speed
+        self.key = key
+        self.lock = threading.Lock()
+        self.queues = defaultdict( deque )
+        self.last = {}
+        for entry in entries:
+            self.queues[ key( entry ) ].append( entry )
+
+    def next( self, entry_key ):
+        with self.lock:
+            queue = self.queues.get( entry_key )
+            if queue:
+                entry = queue.popleft()
+                self.last[ entry_key ] = entry
+            else:
+                entry = self.last.get( entry_key )
+        if entry is None:
+            return None
+        if self.speed != float( 'inf' ):
+            time.sleep( entry.get( 'duration', 0.0 ) / self.speed )
+        return entry
+
+
+def wait_until( origin, started, ts, speed ):
+    if speed == float( 'inf' ):
+        return
+    delay = ( ts - origin ) / speed - ( time.monotonic() - started )
+    if delay > 0:
+        time.sleep( delay )
+
+
+def replay_bravia( entries, speed ):
+    import bravia_server
+    from bravia_server import (
+        AdmissionController,
+        BraviaHandler,
+        BraviaTVError,
+        Device,
+        DeviceRegistry,
+        DEVICE_KEYS,
+        MediaController,
+        StateHub,
+    )
+
+    def key( entry ):
+        return (
+            entry[ 'kind' ],
+            entry.get( 'device' ),
+            json.dumps( entry[ 'request' ],
+                        sort_keys = True )
+        )
+
+    upstream = [ entry for entry in entries if entry.get( 'device' ) ]
+    devices = [
+        entry[ 'request' ] for entry in entries if entry[ 'kind' ] == 'device'
+    ]
+    hdmi_ports = {
+        device[ 'name' ]: device[ 'tv_hdmi_port' ]
+        for device in devices
+    }
+    macros = {}
+    for entry in entries:
+        if entry[ 'kind' ] == 'macros':
+            macros = entry[ 'request' ]
+    default = next(
+        ( device[ 'name' ] for device in devices if device.get( 'default' ) ),
+        None
+    )
+    requests = [ entry for entry in entries if entry[ 'kind' ] == 'http' ]
+    if not requests:
+        sys.exit( "Trace has no 'http' entries to replay" )
+    responder = Responder( upstream, speed, key )
+
+    def replayed( kind, request_of ):
+        def call( self, *args ):
+            entry = responder.next(
+                (
+                    kind,
+                    self.device.name,
+                    json.dumps( request_of( *args ),
+                                sort_keys = True )
+                )
+            )
+            if entry is None:
+                raise BraviaTVError( f"No recorded {kind} for {args}" )
+            if entry.get( 'error' ):
+                raise BraviaTVError( entry[ 'error' ] )
+            return entry.get( 'response' )
+
+        return call
+
+    MediaController.tv_req = replayed(
+        'tv_req', lambda service, method, params = None: {
+            "service": service, "method": method, "params": params
+        }
+    )
+    MediaController.tv_ircc = replayed(
+        'tv_ircc', lambda code_key: {
+            "code_key": code_key
+        }
+    )
+    MediaController.kodi_stop = replayed( 'kodi_stop', lambda: {} )
+    bravia_server.wake_on_lan = lambda mac: None
+
+    rooms = sorted(
+        set( hdmi_ports ) | { entry[ 'device' ]
+                              for entry in upstream }
+    )
+    placeholders = {
+        key: 'replay'
+        for key in DEVICE_KEYS
+    }
+    registry = DeviceRegistry(
+        [
+            Device(
+                room,
+                **dict(
+                    placeholders,
+                    tv_hdmi_port = hdmi_ports.get( room,
+                                                   '1' )
+                )
+            ) for room in rooms or [ bravia_server.DEFAULT_DEVICE ]
+        ],
+        default,
+        macros
+    )
+    server = bravia_server.BraviaHTTPServer( ( '127.0.0.1', 0 ), BraviaHandler )
+    server.registry = registry
+    server.hub = StateHub( registry )
+    # one local client replays what many clients sent: no per-client limit
+    server.admission = AdmissionController( rate = None )
+    BraviaHandler.log_message = lambda self, *args: None
+    threading.Thread( target = server.serve_forever, daemon = True ).start()
+
+    connection = http.client.HTTPConnection( '127.0.0.1', server.server_port )
+    latencies = defaultdict( list )
+    recorded = defaultdict( list )
+    origin, started = requests[ 0 ][ 'ts' ], time.monotonic()
+    for entry in requests:
+        wait_until( origin, started, entry[ 'ts' ], speed )
+        path = entry[ 'request' ][ 'path' ]
+        _, slug, scope = registry.resolve( path )
+        name = f"{scope or ''}/{slug}"
+        t0 = time.perf_counter()
+        connection.request(
+            entry[ 'request' ].get( 'method',
+                                    'GET' ),
+            path,
+            body = entry[ 'request' ].get( 'body' )
+        )
+        connection.getresponse().read()
+        latencies[ name ].append( time.perf_counter() - t0 )
+        recorded[ name ].append( entry.get( 'duration', 0.0 ) )
+    server.shutdown()
+    report( latencies, recorded )
+
+
+def install_kodi_modules( responder, profile ):
+    """
+    Minimal stand-ins for the Kodi modules so MainService runs offline.
+    Files the service writes to its profile (e.g. on dumpJournal) go to
+    the profile directory given.
+    """
+    xbmc = types.ModuleType( 'xbmc' )
+    for level, name in enumerate(
+        ( 'LOGDEBUG', 'LOGINFO', 'LOGWARNING', 'LOGERROR', 'LOGFATAL' )
+    ):
+        setattr( xbmc, name, level )
+    xbmc.log = lambda msg, level = 0: None
+    xbmc.executebuiltin = lambda command: None
+    xbmc.getCondVisibility = lambda condition: True
+
+    def executeJSONRPC( payload ):
+        request = json.loads( payload )
+        entry = responder.next( request.get( 'method' ) )
+        return entry.get( 'response' ) if entry else ''
+
+    xbmc.executeJSONRPC = executeJSONRPC
+
+    class Monitor:
+        def abortRequested( self ):
+            return True
+
+        def waitForAbort( self, timeout = None ):
+            return True
+
+    class Player:
+        def __getattr__( self, name ):
+            return lambda *args, **kwargs: None
+
+    xbmc.Monitor = Monitor
+    xbmc.Player = Player
+
+    xbmcaddon = types.ModuleType( 'xbmcaddon' )
+
+    class Addon:
+        def getSetting( self, key ):
+            return {
+                'preferred_language': 'eng'
+            }.get( key,
+                   '' )
+
+        def getAddonInfo( self, key ):
+            return profile if key == 'profile' else ''
+
+    xbmcaddon.Addon = Addon
+    xbmcvfs = types.ModuleType( 'xbmcvfs' )
+    xbmcvfs.translatePath = lambda path: path
+    xbmcvfs.mkdirs = lambda path: True
+    sys.modules.update( xbmc = xbmc, xbmcaddon = xbmcaddon, xbmcvfs = xbmcvfs )
+
+
+def replay_kodi( entries, speed ):
+    rpc = [ entry for entry in entries if entry[ 'kind' ] == 'json_rpc' ]
+    callbacks = [ entry for entry in entries if entry[ 'kind' ] == 'callback' ]
+    if not callbacks:
+        sys.exit( "Trace has no 'callback' entries to replay" )
+    responder = Responder(
+        rpc,
+        speed, lambda entry: entry[ 'request' ].get( 'method' )
+    )
+    with tempfile.TemporaryDirectory( prefix = 'trace-replay-' ) as profile:
+        install_kodi_modules( responder, profile )
+        from main_service import MainService
+
+        service = MainService()
+        latencies = defaultdict( list )
+        origin, started = callbacks[ 0 ][ 'ts' ], time.monotonic()
+        for entry in callbacks:
+            wait_until( origin, started, entry[ 'ts' ], speed )
+            name = entry[ 'request' ][ 'name' ]
+            args = entry[ 'request' ].get( 'args', [] )
+            t0 = time.perf_counter()
+            getattr( service, name )( *args )
+            label = name if name != 'onNotification' else f"{name}:{args[ 1 ]}"
+            latencies[ label ].append( time.perf_counter() - t0 )
+    report( latencies )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = __doc__.split( '\n' )[ 1 ] )
+    parser.add_argument( 'target', choices = ( 'bravia', 'kodi' ) )
+    parser.add_argument( 'trace' )
+    parser.add_argument(
+        '--speed',
+        type = float,
+        default = 1.0,
+        help = 'time scale; 1 is real time, inf skips all waits'
+    )
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error( '--speed must be positive' )
+    entries = load_trace( args.trace )
+    if args.target == 'bravia':
+        replay_bravia( entries, args.speed )
+    else:
+        replay_kodi( entries, args.speed )
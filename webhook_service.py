@@ -1,15 +1,71 @@
-import requests
+import threading
+import time
+from urllib.parse import urlsplit
+
 import xbmc
 
+from event_protocol import EventSender
+from journal import journal
 from logger import Logger
 
 
 class WebhookControl( Logger ):
-    def __init__( self, url ):
+    # further wake signals within this many seconds of one are dropped
+    __WAKE_INTERVAL__ = 15
+
+    def __init__( self, url, event_url = None ):
         self.url = url.rstrip( '/' )
+        # the room the webhook URL addresses, e.g. http://host:8081/living
+        self.room = urlsplit( self.url ).path.strip( '/' )
+        self.sender = None
+        if event_url:
+            try:
+                self.sender = EventSender( event_url )
+            except ValueError as e:
+                self.log( str( e ), xbmc.LOGERROR )
+        self.wake_lock = threading.Lock()
+        self.woken_at = None
+
+    def wake( self, source ):
+        """
+        Sends onScreensaverDeactivated in the background, so the TV starts
+        booting while Kodi is still redrawing. Several signals arrive for one
+        wake-up; only the first within __WAKE_INTERVAL__ is sent.
+        """
+        with self.wake_lock:
+            now = time.monotonic()
+            duplicate = self.woken_at is not None and (
+                now - self.woken_at < WebhookControl.__WAKE_INTERVAL__
+            )
+            if not duplicate:
+                self.woken_at = now
+        if duplicate:
+            journal.add( 'wake', 'dropped', detail = source )
+            return False
+        journal.add( 'wake', detail = source )
+        threading.Thread(
+            target = self.run,
+            kwargs = {
+                'method': 'onScreensaverDeactivated'
+            },
+            daemon = True
+        ).start()
+        return True
+
+    def hold_wake( self, source ):
+        """
+        Drops wake signals for the next __WAKE_INTERVAL__ without sending
+        one, e.g. when the screensaver ended because Kodi is shutting down.
+        """
+        with self.wake_lock:
+            self.woken_at = time.monotonic()
+        journal.add( 'wake', 'held', detail = source )
 
     def run( self, method ):
         if method == 'onScreensaverActivated':
+            # the TV goes off, so the next wake signal must get through
+            with self.wake_lock:
+                self.woken_at = None
             url = self.url + '/onScreensaverActivated'
         elif method == 'onScreensaverDeactivated':
             url = self.url + '/onScreensaverDeactivated'
@@ -19,10 +75,53 @@ class WebhookControl( Logger ):
                 f'Notification(Zumbrella Warning, Invalid method: {method}, 5000)'
             )
             return None
+        if self.sender is not None and self.send_event( method ):
+            return None
+        # only loaded when needed, the datagram path does without it
+        import requests
+        started = time.time()
         try:
             response = requests.get( url, timeout = 10 )
             response.raise_for_status()
+            journal.add(
+                f'webhook:{method}',
+                duration = time.time() - started,
+                detail = response.status_code,
+                timestamp = started
+            )
             return response.json()
         except requests.exceptions.RequestException as e:
+            journal.add(
+                f'webhook:{method}',
+                'error',
+                time.time() - started,
+                type( e ).__name__,
+                timestamp = started
+            )
             self.log( f'Error sending webhook to {url}: {e}', xbmc.LOGERROR )
             return None
+
+    def send_event( self, method ):
+        """Sends method as a datagram; False if HTTP has to be used."""
+        started = time.time()
+        try:
+            self.sender.send( method, self.room )
+        except OSError as e:
+            journal.add(
+                f'event:{method}',
+                'error',
+                time.time() - started,
+                type( e ).__name__,
+                timestamp = started
+            )
+            self.log(
+                f'Event socket unavailable ({e}), falling back to HTTP',
+                xbmc.LOGWARNING
+            )
+            return False
+        journal.add(
+            f'event:{method}',
+            duration = time.time() - started,
+            timestamp = started
+        )
+        return True